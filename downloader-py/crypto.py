@@ -1,82 +1,100 @@
-import base64
+import pybase64
+import os
+import struct
 import time
-import json
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
-from urllib.parse import quote, unquote
+from functools import lru_cache
+from typing import Tuple, Union
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+# Clear-text token header: creation timestamp (ms) and TTL (s), authenticated as AAD
+HEADER = struct.Struct(">QI")
+NONCE_SIZE = 12  # 96-bit nonce, the size GCM is designed for
 
-def encrypt(text, key, ttl_in_seconds):
+
+@lru_cache(maxsize=8)
+def _get_aead(key: Union[str, bytes]) -> AESGCM:
     """
-    Encrypt text with AES, adding timestamp and TTL for expiration check
+    Derive a 256-bit AES key from the configured secret once and cache the
+    resulting AESGCM object, so repeated calls with the same key skip the HKDF work
     """
-    timestamp = int(time.time() * 1000)  # Current time in milliseconds
-    text_with_timestamp = f"{timestamp}_*_{ttl_in_seconds}_*_{text}"
-    
     # Convert key to bytes if it's not already
     if isinstance(key, str):
         key = key.encode('utf-8')
-    
-    # Ensure key is appropriate length for AES (16, 24, or 32 bytes)
-    if len(key) not in [16, 24, 32]:
-        key = pad(key, 16)[:32]  # Pad and use first 32 bytes
-    
-    # Create cipher and encrypt
-    cipher = AES.new(key, AES.MODE_CBC)
-    ct_bytes = cipher.encrypt(pad(text_with_timestamp.encode('utf-8'), AES.block_size))
-    
-    # Combine IV and ciphertext for storage/transmission
-    iv = cipher.iv
-    ct_with_iv = iv + ct_bytes
-    
-    # Encode to base64
-    encrypted_b64 = base64.b64encode(ct_with_iv).decode('utf-8')
-    
-    # URL encode for safe transmission
-    return quote(encrypted_b64)
-
-
-def decrypt(encrypted_text, key):
+
+    derived = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"download-link-token",
+    ).derive(key)
+    return AESGCM(derived)
+
+
+def encrypt(text: Union[str, bytes], key: Union[str, bytes], ttl_in_seconds: int) -> str:
+    """
+    Encrypt text with AES-GCM, adding timestamp and TTL for expiration check
+
+    text may be given as UTF-8 bytes (e.g. straight from orjson.dumps) to skip the encode step
+    """
+    timestamp = time.time_ns() // 1_000_000  # Current time in milliseconds
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    header = HEADER.pack(timestamp, ttl_in_seconds)
+
+    # AES-GCM via OpenSSL EVP (uses AES-NI / ARMv8 crypto extensions). The header
+    # stays readable but is authenticated, so the expiry can't be tampered with
+    nonce = os.urandom(NONCE_SIZE)
+    ct_bytes = _get_aead(key).encrypt(nonce, text, header)
+
+    # Combine header, nonce and ciphertext (with tag) for storage/transmission
+    token = header + nonce + ct_bytes
+
+    # URL-safe base64 without padding - nothing left that needs percent-encoding
+    return pybase64.urlsafe_b64encode(token).rstrip(b'=').decode('ascii')
+
+
+def decrypt(encrypted_text: str, key: Union[str, bytes]) -> str:
     """
     Decrypt text and check if it has expired based on timestamp and TTL
     """
+    return decrypt_with_expiry(encrypted_text, key)[0]
+
+
+def decrypt_with_expiry(encrypted_text: str, key: Union[str, bytes]) -> Tuple[str, int]:
+    """
+    Like decrypt, but also return the token's expiration time (epoch milliseconds)
+    so callers that cache the result can keep honouring it
+    """
     try:
-        # URL decode
-        decoded_text = unquote(encrypted_text)
-        
-        # Base64 decode
-        encrypted_bytes = base64.b64decode(decoded_text)
-        
-        # Extract IV (first 16 bytes) and ciphertext
-        iv = encrypted_bytes[:16]
-        ct = encrypted_bytes[16:]
-        
-        # Convert key to bytes if it's not already
-        if isinstance(key, str):
-            key = key.encode('utf-8')
-        
-        # Ensure key is appropriate length for AES
-        if len(key) not in [16, 24, 32]:
-            key = pad(key, 16)[:32]  # Pad and use first 32 bytes
-        
-        # Decrypt
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        decrypted_padded = cipher.decrypt(ct)
-        decrypted = unpad(decrypted_padded, AES.block_size).decode('utf-8')
-        
-        # Split timestamp, TTL and original text
-        timestamp_str, ttl_str, original_text = decrypted.split("_*_")
-        timestamp = int(timestamp_str)
-        ttl = int(ttl_str)
-        
-        # Check expiration
+        # Restore the stripped base64 padding and decode
+        padded_text = encrypted_text + '=' * (-len(encrypted_text) % 4)
+        encrypted_bytes = pybase64.urlsafe_b64decode(padded_text)
+
+        # Split header, nonce and ciphertext
+        if len(encrypted_bytes) < HEADER.size + NONCE_SIZE:
+            raise ValueError("Malformed token.")
+        header = encrypted_bytes[:HEADER.size]
+        nonce = encrypted_bytes[HEADER.size:HEADER.size + NONCE_SIZE]
+        ct = encrypted_bytes[HEADER.size + NONCE_SIZE:]
+        timestamp, ttl = HEADER.unpack(header)
+
+        # Check expiration from the clear header before decrypting, so expired
+        # links are rejected early (a forged header still fails the tag check below)
         expiration_time = timestamp + (ttl * 1000)  # Convert to milliseconds
-        current_time = int(time.time() * 1000)
-        
+        current_time = time.time_ns() // 1_000_000
+
         if current_time > expiration_time:
             raise ValueError("Link expired and cannot be decrypted.")
-            
-        return original_text
-        
+
+        try:
+            decrypted = _get_aead(key).decrypt(nonce, ct, header)
+        except InvalidTag:
+            raise ValueError("Invalid or tampered token.")
+
+        return decrypted.decode('utf-8'), expiration_time
+
     except Exception as e:
-        raise ValueError(f"Decryption failed: {str(e)}")
\ No newline at end of file
+        raise ValueError(f"Decryption failed: {str(e)}")
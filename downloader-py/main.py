@@ -1,38 +1,105 @@
 import os
-import json
+import re
+import logging
+import queue
 import time
 import shutil
 import tempfile
-from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from types import MappingProxyType
 from typing import Optional, Dict, Any, List
+import aiofiles
 import httpx
+import orjson
+from cachetools import TTLCache
 import asyncio
 import uvicorn
-import uvloop  # Added uvloop for better performance
 import uuid
 from urllib.parse import quote
 
 from fastapi.responses import StreamingResponse
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Response
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse
 from pydantic import BaseModel, Field
 from starlette.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware  # Added for response compression
+from starlette.middleware.gzip import GZipResponder
+from starlette.datastructures import Headers
+from starlette.types import Message, Receive, Scope, Send
 
-from crypto import encrypt, decrypt
+try:
+    # mypyc-compiled build of crypto.py from the Dockerfile
+    from crypto_native import encrypt, decrypt_with_expiry
+except ImportError:
+    from crypto import encrypt, decrypt_with_expiry
+
+logger = logging.getLogger(__name__)
 
 # Constants
 BASE_URL = os.getenv("BASE_URL", "https://d.snaptik.fit")  # From .env file
 ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY", "overflow")  # Changed to use env var with fallback
 TEMP_DIR = os.path.join(os.getcwd(), "temp")
 HYBRID_API_URL = os.getenv("DOUYIN_API_URL", "http://douyin_tiktok_download_api:8000/api/hybrid/video_data")
+# Runs of non-word characters (\W is exactly what str.isalnum() rejects, minus the
+# underscore) - each run becomes a single "_" in generated filenames
+NON_ALNUM_RE = re.compile(r"\W+")
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128")
+# libx264 runs with -threads 0 (one thread per core), so a few concurrent encodes
+# already saturate the CPU - keep the default bound small
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", max(1, (os.cpu_count() or 2) // 4)))
+STREAM_CHUNK_SIZE = 256 * 1024  # 256KB - about one TCP window, far fewer yields per MB than 8KB
+IDENTITY_ENCODING = {"Accept-Encoding": "identity"}
+SLIDESHOW_DOWNLOAD_CONCURRENCY = 6  # Max simultaneous CDN fetches per slideshow
 
 # Create temp directory if it doesn't exist
 os.makedirs(TEMP_DIR, exist_ok=True)
 
-# Storage for file timestamps - for smarter temp file management
-file_timestamps = {}
+# Media type -> (content type, file extension) for /download
+CONTENT_TYPES = MappingProxyType({
+    "mp3": ("audio/mpeg", "mp3"),
+    "video": ("video/mp4", "mp4"),
+    "image": ("image/jpeg", "jpg")
+})
+
+# Shared read-only default for .get() lookups on upstream data, so missing keys
+# don't allocate a fresh dict each time - never mutate it
+_EMPTY: Dict[str, Any] = {}
+
+# In-process caches (per worker). Hybrid API results are reused for repeat
+# lookups of the same URL; decrypted tokens for repeat/retried downloads. Decrypted
+# tokens are stored with their own expiry, which is re-checked on every hit.
+hybrid_cache = TTLCache(maxsize=4096, ttl=300)
+hybrid_fetch_locks: Dict[str, asyncio.Lock] = {}
+decrypt_cache: TTLCache = TTLCache(maxsize=8192, ttl=60)  # token -> (plaintext, expiry ms)
+
+# Sentinel file inside each slideshow temp dir - its mtime is the creation time,
+# visible to every worker process (unlike an in-memory dict)
+CREATED_SENTINEL = ".created"
+
+class DeferredFormatQueueHandler(QueueHandler):
+    """
+    QueueHandler that enqueues the record as-is. The stock prepare() formats the
+    message (and renders any traceback) in the calling thread; in-process the
+    listener can do that itself from the original record
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def start_logging() -> QueueListener:
+    """
+    Route log records through a queue so formatting and the stderr write happen
+    on the listener thread instead of the request path
+    """
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    logging.basicConfig(level=logging.WARNING, handlers=[DeferredFormatQueueHandler(log_queue)])
+    # Keep this module's own INFO notices (e.g. temp dir removal), which used to be printed
+    logger.setLevel(logging.INFO)
+    return listener
 
 # Models
 class TikTokRequest(BaseModel):
@@ -41,7 +108,37 @@ class TikTokRequest(BaseModel):
 class DownloadQueryParams(BaseModel):
     data: str
 
-app = FastAPI(title="TikTok Downloader API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Set up here rather than in __main__ so it also applies under the uvicorn CLI / gunicorn
+    log_listener = start_logging()
+    
+    # Shared HTTP client - keeps connections (and TLS sessions) to the hybrid API
+    # and the CDNs alive across requests instead of reconnecting every time
+    app.state.client = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+            retries=1  # Retry once on connection failures
+        ),
+        timeout=30.0
+    )
+    
+    # Pick the slideshow video encoder once per process
+    app.state.video_encoder = await detect_video_encoder()
+    
+    # Scheduled task for cleaning up temp files
+    cleanup_task = asyncio.create_task(run_cleanup_scheduler())
+    
+    try:
+        yield
+    finally:
+        cleanup_task.cancel()
+        await app.state.client.aclose()
+        log_listener.stop()
+
+# orjson-backed default response class for the JSON endpoints
+app = FastAPI(title="TikTok Downloader API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # CORS configuration
 app.add_middleware(
@@ -53,94 +150,86 @@ app.add_middleware(
     expose_headers=["content-disposition", "x-filename"],
 )
 
+# Content types that are already entropy-coded - gzip only burns CPU on them
+INCOMPRESSIBLE_TYPES = ("video/", "audio/", "image/")
+
+class MediaAwareGZipResponder(GZipResponder):
+    """GZipResponder that forwards already-compressed media untouched"""
+    passthrough = False
+
+    async def send_with_gzip(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            self.passthrough = content_type.startswith(INCOMPRESSIBLE_TYPES)
+        
+        if self.passthrough:
+            await self.send(message)
+        else:
+            await super().send_with_gzip(message)
+
+class CompressibleGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware that skips video/audio/image responses (/download, /download-slideshow)"""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = MediaAwareGZipResponder(
+                self.app, self.minimum_size, compresslevel=self.compresslevel
+            )
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
 # Add compression middleware (Optimization 4: Response Compression)
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+# Level 1 gets nearly the full ratio on small, repetitive JSON for a fraction of the CPU;
+# bodies under 2KB aren't worth the gzip framing and a CPU pass at all
+app.add_middleware(CompressibleGZipMiddleware, minimum_size=2048, compresslevel=1)
 
 # Background task to remove expired temp files
 # Optimization 5: Smarter Temp File Management
 async def cleanup_temp_files():
     """Remove temporary files and folders older than 1 hour with improved tracking"""
     try:
-        current_time = datetime.now()
+        # Anything created before this moment is older than 1 hour
+        cutoff = time.time() - 60 * 60
         expired_items = []
         
         # First pass: identify expired items
-        for item in os.listdir(TEMP_DIR):
-            item_path = os.path.join(TEMP_DIR, item)
-            if os.path.isdir(item_path):
-                # Check if we have a timestamp recorded
-                if item_path in file_timestamps:
-                    timestamp = file_timestamps[item_path]
-                else:
-                    # Get folder modification time if no timestamp recorded
-                    timestamp = datetime.fromtimestamp(os.path.getmtime(item_path))
-                    file_timestamps[item_path] = timestamp
-                
+        # scandir returns the entry type with the directory listing, so an empty
+        # TEMP_DIR on an idle worker costs a single syscall
+        with os.scandir(TEMP_DIR) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                item_path = entry.path
+                # Creation time comes from the sentinel, shared by all workers
+                try:
+                    timestamp = os.stat(os.path.join(item_path, CREATED_SENTINEL)).st_mtime
+                except OSError:
+                    # No sentinel - fall back to the folder modification time
+                    timestamp = entry.stat(follow_symlinks=False).st_mtime
+
                 # If older than 1 hour, mark for removal
-                if current_time - timestamp > timedelta(hours=1):
+                if timestamp < cutoff:
                     expired_items.append(item_path)
         
         # Second pass: remove expired items
         for item_path in expired_items:
             try:
                 shutil.rmtree(item_path)
-                # Remove from timestamps dictionary
-                if item_path in file_timestamps:
-                    del file_timestamps[item_path]
-                print(f"Removed old temp directory: {item_path}")
+                logger.info("Removed old temp directory: %s", item_path)
             except Exception as e:
-                print(f"Error removing directory {item_path}: {e}")
-    except Exception as e:
-        print(f"Error in cleanup task: {e}")
-
-# Scheduled task for cleaning up temp files
-@app.on_event("startup")
-async def start_scheduler():
-    asyncio.create_task(run_cleanup_scheduler())
+                logger.warning("Error removing directory %s: %s", item_path, e)
+    except Exception:
+        logger.exception("Error in cleanup task")
 
 async def run_cleanup_scheduler():
+    loop = asyncio.get_running_loop()
     while True:
+        # Run every 30 minutes, on a monotonic deadline so the cleanup's own
+        # run time doesn't push each following pass later
+        deadline = loop.time() + 30 * 60
         await cleanup_temp_files()
-        # Run every 30 minutes
-        await asyncio.sleep(30 * 60)
-
-def get_nested_value(data, keys, default=None):
-    """
-    Safely get nested dictionary values with fallback
-    
-    Args:
-        data (dict): The dictionary to extract from
-        keys (list): List of keys to traverse
-        default: Default value if any key is missing
-        
-    Returns:
-        The value or default if not found
-    """
-    result = data
-    for key in keys:
-        if not isinstance(result, dict):
-            return default
-        result = result.get(key, default)
-        if result is None:
-            return default
-    return result
-
-
-def get_first_from_nested_list(data, keys, default=''):
-    """
-    Safely get the first item from a nested list within a dictionary
-    
-    Args:
-        data (dict): The dictionary to extract from
-        keys (list): List of keys to traverse
-        default: Default value if any key is missing or list is empty
-        
-    Returns:
-        The first list item or default if not found
-    """
-    nested_list = get_nested_value(data, keys, [])
-    return nested_list[0] if nested_list else default
-
+        await asyncio.sleep(max(0, deadline - loop.time()))
 
 def generate_encrypted_download_link(url, author_nickname, media_type, encryption_key, base_url, expiry=360):
     """
@@ -162,7 +251,7 @@ def generate_encrypted_download_link(url, author_nickname, media_type, encryptio
     
     try:
         encrypted_url = encrypt(
-            json.dumps({
+            orjson.dumps({
                 "url": url,
                 "author": author_nickname,
                 "type": media_type
@@ -171,8 +260,8 @@ def generate_encrypted_download_link(url, author_nickname, media_type, encryptio
             expiry
         )
         return f"{base_url}/download?data={encrypted_url}"
-    except Exception as e:
-        print(f"Error generating download link for {media_type}: {e}")
+    except Exception:
+        logger.exception("Error generating download link for %s", media_type)
         return None
 
 
@@ -188,24 +277,28 @@ def generate_json_response(data: Dict[str, Any], url: str = '') -> Dict[str, Any
         dict: Formatted response with metadata and download links
     """
     try:
-        video_data = data.get("data", {})
+        video_data = data.get("data", _EMPTY)
         
         # Check content type
         is_image = video_data.get("type") == "image"
         
         # Extract author data
-        author = video_data.get("author", {})
+        author = video_data.get("author", _EMPTY)
         author_nickname = author.get("nickname", "Unknown")
         
+        # Resolve nested URL lists once, falling back to the shared empty mapping
+        avatar_list = (author.get("avatar_thumb") or _EMPTY).get("url_list")
+        cover_list = ((video_data.get("cover_data") or _EMPTY).get("cover") or _EMPTY).get("url_list")
+        
         # Build author metadata
         filtered_author = {
             "nickname": author_nickname,
             "signature": author.get("signature", ""),
-            "avatar": get_first_from_nested_list(author, ["avatar_thumb", "url_list"])
+            "avatar": avatar_list[0] if avatar_list else ""
         }
         
         # Extract statistics
-        statistics = video_data.get("statistics", {})
+        statistics = video_data.get("statistics", _EMPTY)
         stats_metadata = {
             "repost_count": statistics.get("repost_count", 0),
             "comment_count": statistics.get("comment_count", 0),
@@ -214,9 +307,9 @@ def generate_json_response(data: Dict[str, Any], url: str = '') -> Dict[str, Any
         }
         
         # Extract music data
-        music = video_data.get("music", {})
-        music_url = get_nested_value(music, ["play_url", "uri"], 
-                    get_nested_value(music, ["play_url", "url"], ""))
+        music = video_data.get("music", _EMPTY)
+        play_url = music.get("play_url") or _EMPTY
+        music_url = play_url.get("uri") or play_url.get("url") or ""
         
         # Basic metadata common to both image and video
         metadata = {
@@ -224,7 +317,7 @@ def generate_json_response(data: Dict[str, Any], url: str = '') -> Dict[str, Any
             "description": video_data.get("desc", ""),
             "statistics": stats_metadata,
             "artist": author_nickname,
-            "cover": get_first_from_nested_list(video_data, ["cover_data", "cover", "url_list"]),
+            "cover": cover_list[0] if cover_list else "",
             "duration": video_data.get("duration", 0),
             "audio": music_url,
             "music_duration": music.get("duration", 0),
@@ -242,8 +335,8 @@ def generate_json_response(data: Dict[str, Any], url: str = '') -> Dict[str, Any
         # Image-specific processing
         if is_image:
             # Get image list
-            image_data = video_data.get("image_data", {})
-            no_watermark_images = image_data.get("no_watermark_image_list", [])
+            image_data = video_data.get("image_data", _EMPTY)
+            no_watermark_images = image_data.get("no_watermark_image_list", ())
             
             # Create picker for image gallery
             picker = [
@@ -252,13 +345,17 @@ def generate_json_response(data: Dict[str, Any], url: str = '') -> Dict[str, Any
             ]
             
             # Generate image download links
-            encrypted_image_links = []
-            for img_url in no_watermark_images:
-                link = generate_encrypted_download_link(
-                    img_url, author_nickname, "image", ENCRYPTION_KEY, BASE_URL
+            # Hoist everything that doesn't depend on the image URL out of the loop
+            link_prefix = f"{BASE_URL}/download?data="
+            encrypted_image_links = [
+                link_prefix + encrypt(
+                    orjson.dumps({"url": img_url, "author": author_nickname, "type": "image"}),
+                    ENCRYPTION_KEY,
+                    360
                 )
-                if link:
-                    encrypted_image_links.append(link)
+                for img_url in no_watermark_images
+                if img_url
+            ]
             
             if encrypted_image_links:
                 metadata["download_link"]["no_watermark"] = encrypted_image_links
@@ -266,8 +363,8 @@ def generate_json_response(data: Dict[str, Any], url: str = '') -> Dict[str, Any
             # Add slideshow download link
             try:
                 metadata["download_slideshow_link"] = f"{BASE_URL}/download-slideshow?url={encrypt(url, ENCRYPTION_KEY, 360)}"
-            except Exception as e:
-                print(f"Error generating slideshow link: {e}")
+            except Exception:
+                logger.exception("Error generating slideshow link")
             
             return {
                 "status": "picker",
@@ -277,22 +374,24 @@ def generate_json_response(data: Dict[str, Any], url: str = '') -> Dict[str, Any
             
         # Video-specific processing
         else:
-            video_urls = video_data.get("video_data", {})
+            video_urls = video_data.get("video_data", _EMPTY)
             
             # Generate all video download links
+            # The variants often share a URL (e.g. wm == wm_HQ) - encrypt each distinct URL once
+            link_cache = {}
+            
+            def video_link(video_url):
+                if video_url not in link_cache:
+                    link_cache[video_url] = generate_encrypted_download_link(
+                        video_url, author_nickname, "video", ENCRYPTION_KEY, BASE_URL
+                    )
+                return link_cache[video_url]
+            
             download_links = {
-                "watermark": generate_encrypted_download_link(
-                    video_urls.get("wm_video_url"), author_nickname, "video", ENCRYPTION_KEY, BASE_URL
-                ),
-                "watermark_hd": generate_encrypted_download_link(
-                    video_urls.get("wm_video_url_HQ"), author_nickname, "video", ENCRYPTION_KEY, BASE_URL
-                ),
-                "no_watermark": generate_encrypted_download_link(
-                    video_urls.get("nwm_video_url"), author_nickname, "video", ENCRYPTION_KEY, BASE_URL
-                ),
-                "no_watermark_hd": generate_encrypted_download_link(
-                    video_urls.get("nwm_video_url_HQ"), author_nickname, "video", ENCRYPTION_KEY, BASE_URL
-                )
+                "watermark": video_link(video_urls.get("wm_video_url")),
+                "watermark_hd": video_link(video_urls.get("wm_video_url_HQ")),
+                "no_watermark": video_link(video_urls.get("nwm_video_url")),
+                "no_watermark_hd": video_link(video_urls.get("nwm_video_url_HQ"))
             }
             
             # Add mp3 link (already generated above)
@@ -310,9 +409,7 @@ def generate_json_response(data: Dict[str, Any], url: str = '') -> Dict[str, Any
             
     except Exception as e:
         # Log the error with traceback
-        import traceback
-        print(f"Error in generate_json_response: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error in generate_json_response")
         
         # Return a minimal valid response
         return {
@@ -321,17 +418,37 @@ def generate_json_response(data: Dict[str, Any], url: str = '') -> Dict[str, Any
             "url": url
         }
 
-@app.post("/tiktok")
-async def tiktok_endpoint(request: TikTokRequest):
-    """Handle TikTok URL processing"""
-    if not request.url:
-        raise HTTPException(status_code=400, detail="URL parameter is required")
+async def fetch_hybrid_data(url: str) -> Dict[str, Any]:
+    """
+    Fetch video data from the hybrid API, with a short-lived in-process cache
+    
+    The body is parsed straight from the raw bytes with orjson - no text
+    decoding step and no intermediate model objects. Concurrent misses for
+    the same URL share a single upstream request.
+    
+    Args:
+        url (str): TikTok/Douyin URL to resolve
+        
+    Returns:
+        dict: Parsed hybrid API payload (shared - treat as read-only)
+    """
+    cached = hybrid_cache.get(url)
+    if cached is not None:
+        return cached
+    
+    lock = hybrid_fetch_locks.get(url)
+    if lock is None:
+        lock = hybrid_fetch_locks[url] = asyncio.Lock()
     
     try:
-        # Fetch data from the hybrid API
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{HYBRID_API_URL}?url={request.url}&minimal=true",
+        async with lock:
+            # Another request may have filled the cache while we waited
+            cached = hybrid_cache.get(url)
+            if cached is not None:
+                return cached
+            
+            response = await app.state.client.get(
+                f"{HYBRID_API_URL}?url={url}&minimal=true",
                 headers={"Content-Type": "application/json"},
                 timeout=30.0
             )
@@ -342,23 +459,62 @@ async def tiktok_endpoint(request: TikTokRequest):
                     detail=f"Failed to fetch data from external API: {response.status_code}"
                 )
             
-            data = response.json()
-            
-            # Generate and return JSON response
-            return generate_json_response(data, request.url)
+            data = orjson.loads(response.content)
+            hybrid_cache[url] = data
+            return data
+    finally:
+        # Drop the lock once nobody holds it, so the dict doesn't grow per URL
+        if not lock.locked() and hybrid_fetch_locks.get(url) is lock:
+            del hybrid_fetch_locks[url]
+
+def decrypt_cached(token: str) -> str:
+    """Decrypt a link token, reusing the result for repeated hits on the same link"""
+    cached = decrypt_cache.get(token)
+    if cached is not None:
+        decrypted, expiration_time = cached
+        if time.time_ns() // 1_000_000 <= expiration_time:
+            return decrypted
+        # Expired since it was cached - decrypting again raises the usual error
+        decrypt_cache.pop(token, None)
+    decrypted, expiration_time = decrypt_with_expiry(token, ENCRYPTION_KEY)
+    decrypt_cache[token] = (decrypted, expiration_time)
+    return decrypted
+
+@app.post("/tiktok")
+async def tiktok_endpoint(request: TikTokRequest):
+    """Handle TikTok URL processing"""
+    if not request.url:
+        raise HTTPException(status_code=400, detail="URL parameter is required")
+    
+    try:
+        # Fetch data from the hybrid API
+        data = await fetch_hybrid_data(request.url)
+        
+        # Generate and return JSON response
+        return generate_json_response(data, request.url)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
 
+def iter_media(response: httpx.Response):
+    """
+    Iterate a media response body. Pass raw bytes through when the CDN honoured
+    identity encoding, but decode if it sent a Content-Encoding anyway, so clients
+    never get compressed bytes labelled as plain media
+    """
+    if response.headers.get("content-encoding", "identity") == "identity":
+        return response.aiter_raw(chunk_size=STREAM_CHUNK_SIZE)
+    return response.aiter_bytes(chunk_size=STREAM_CHUNK_SIZE)
+
 async def download_file(url: str, output_path: str):
     """Download a file from URL to the specified path"""
-    async with httpx.AsyncClient() as client:
-        async with client.stream("GET", url) as response:
-            if response.status_code != 200:
-                raise HTTPException(status_code=500, detail=f"Failed to download file: {response.status_code}")
-            
-            with open(output_path, 'wb') as f:
-                async for chunk in response.aiter_bytes():
-                    f.write(chunk)
+    async with app.state.client.stream("GET", url, headers=IDENTITY_ENCODING) as response:
+        if response.status_code != 200:
+            raise HTTPException(status_code=500, detail=f"Failed to download file: {response.status_code}")
+        
+        # aiofiles runs each write in a worker thread, so disk I/O doesn't stall the event loop
+        async with aiofiles.open(output_path, 'wb') as f:
+            async for chunk in iter_media(response):
+                await f.write(chunk)
 
 @app.get("/download")
 async def download_endpoint(data: str):
@@ -368,8 +524,8 @@ async def download_endpoint(data: str):
     
     try:
         # Decrypt the data
-        decrypted_data = decrypt(data, ENCRYPTION_KEY)
-        parsed_data = json.loads(decrypted_data)
+        decrypted_data = decrypt_cached(data)
+        parsed_data = orjson.loads(decrypted_data)
         
         url = parsed_data.get("url")
         author = parsed_data.get("author")
@@ -379,16 +535,11 @@ async def download_endpoint(data: str):
             raise HTTPException(status_code=400, detail="Invalid decrypted data: missing url, author, or type")
         
         # Determine content type and file extension
-        content_type_map = {
-            "mp3": ("audio/mpeg", "mp3"),
-            "video": ("video/mp4", "mp4"),
-            "image": ("image/jpeg", "jpg")
-        }
-        
-        if file_type not in content_type_map:
+        content_type_info = CONTENT_TYPES.get(file_type)
+        if content_type_info is None:
             raise HTTPException(status_code=400, detail="Invalid file type specified")
         
-        content_type, file_extension = content_type_map[file_type]
+        content_type, file_extension = content_type_info
         
         # Configure the filename
         filename = f"{author}.{file_extension}"
@@ -396,14 +547,15 @@ async def download_endpoint(data: str):
         
         
         async def stream_file():
-            async with httpx.AsyncClient() as client:
-                async with client.stream("GET", url) as response:
-                    if response.status_code != 200:
-                        raise HTTPException(status_code=502, detail=f"Failed to download from source: {response.status_code}")
-                    
-                    async for chunk in response.aiter_bytes(chunk_size=8192):  # 8KB chunks
-                        yield chunk
-        
+            # Media is already compressed - ask the CDN for identity encoding and pass
+            # the raw bytes through without running them through a decoder
+            async with app.state.client.stream("GET", url, headers=IDENTITY_ENCODING) as response:
+                if response.status_code != 200:
+                    raise HTTPException(status_code=502, detail=f"Failed to download from source: {response.status_code}")
+                
+                async for chunk in iter_media(response):
+                    yield chunk
+
         # Return a streaming response
         return StreamingResponse(
             content=stream_file(),
@@ -414,83 +566,143 @@ async def download_endpoint(data: str):
             }
         )
         
+    except HTTPException:
+        # Keep the 400s raised above instead of turning them into 500s
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error downloading file: {str(e)}")
 
 
-# Optimization 10: Asynchronous FFmpeg Processing
-async def create_slideshow(images: List[str], audio_path: str, output_path: str):
-    """Create a slideshow video from images and audio using FFmpeg asynchronously"""
-    import subprocess
-    
-    # Prepare FFmpeg command
-    filter_complex = []
+# H.264 encoders in order of preference. Hardware encoders are only picked when
+# a real test encode succeeds - ffmpeg builds list them even without the device.
+VIDEO_ENCODERS = {
+    "h264_nvenc": {
+        "input_args": [],
+        "filter": "",
+        "output_args": ["-c:v", "h264_nvenc", "-preset", "p1", "-tune", "hq", "-pix_fmt", "yuv420p"],
+    },
+    "h264_vaapi": {
+        "input_args": ["-vaapi_device", VAAPI_DEVICE],
+        "filter": ",format=nv12,hwupload",  # Upload frames to the GPU after scaling
+        "output_args": ["-c:v", "h264_vaapi"],
+    },
+    "libx264": {
+        "input_args": [],
+        "filter": "",
+        "output_args": ["-c:v", "libx264", "-preset", "veryfast", "-tune", "stillimage", "-threads", "0", "-pix_fmt", "yuv420p"],
+    },
+}
+SOFTWARE_ENCODER = "libx264"
+
+# Bound concurrent FFmpeg processes so slideshow bursts don't oversubscribe the CPU/GPU
+ffmpeg_semaphore = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+
+async def _run_ffmpeg_probe(*args):
+    """Run a short FFmpeg command and return (returncode, stdout)"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+    except OSError:
+        return -1, b""
+    stdout, _ = await process.communicate()
+    return process.returncode, stdout
+
+async def detect_video_encoder():
+    """Pick the fastest H.264 encoder that actually works on this host"""
+    returncode, encoders = await _run_ffmpeg_probe("-encoders")
+    if returncode != 0:
+        return SOFTWARE_ENCODER
     
-    # Scale and pad each image
-    for i, _ in enumerate(images):
-        filter_complex.append(
-            f"[{i}:v]scale=w=1080:h=1920:force_original_aspect_ratio=decrease,"
-            f"pad=1080:1920:(ow-iw)/2:(oh-ih)/2:color=black,setsar=1[v{i}]"
+    for name, settings in VIDEO_ENCODERS.items():
+        if name == SOFTWARE_ENCODER or name.encode() not in encoders:
+            continue
+        
+        # Encode a single frame to confirm the device is really there
+        returncode, _ = await _run_ffmpeg_probe(
+            "-loglevel", "error",
+            *settings["input_args"],
+            "-f", "lavfi", "-i", "color=c=black:s=256x256",
+            "-frames:v", "1",
+            "-vf", f"format=yuv420p{settings['filter']}",
+            *settings["output_args"],
+            "-f", "null", "-"
         )
+        if returncode == 0:
+            return name
     
-    # Concatenate all scaled/padded video streams
-    concat_inputs = ''.join(f"[v{i}]" for i in range(len(images)))
-    filter_complex.append(f"{concat_inputs}concat=n={len(images)}:v=1:a=0[vout]")
+    return SOFTWARE_ENCODER
+
+def _escape_concat_path(path):
+    """Quote a path for a single-quoted entry in an FFmpeg concat list"""
+    return path.replace("'", "'\\''")
+
+# Optimization 10: Asynchronous FFmpeg Processing
+async def create_slideshow(images: List[str], audio_path: str, output_path: str):
+    """Create a slideshow video from images and audio using FFmpeg asynchronously"""
+    encoder = VIDEO_ENCODERS[app.state.video_encoder]
     
     # Calculate the total duration of the video
     video_duration = len(images) * 3  # 3 seconds per image
     
-    # Add audio filter to trim the looping audio to the video duration
-    filter_complex.append(f"[{len(images)}:a]atrim=0:{video_duration}[aout]")
-    
-    # Build the command
-    cmd = ["ffmpeg"]
-    
-    # Add input images with loop and duration
+    # Describe the images as a concat demuxer playlist - one demuxer/decoder for
+    # all images instead of N looped inputs joined by an N-way concat filter
+    concat_lines = []
     for image in images:
-        cmd.extend(["-loop", "1", "-t", "3", "-i", image])
+        concat_lines.append(f"file '{_escape_concat_path(image)}'")
+        concat_lines.append("duration 3")
+    # The demuxer ignores the last duration unless the final file is listed again
+    concat_lines.append(f"file '{_escape_concat_path(images[-1])}'")
     
-    # Add audio with loop
-    cmd.extend(["-stream_loop", "-1", "-i", audio_path])
+    concat_path = os.path.join(os.path.dirname(output_path), "images.txt")
+    with open(concat_path, "w") as f:
+        f.write("\n".join(concat_lines) + "\n")
     
-    # Add filter complex
-    cmd.extend(["-filter_complex", ";".join(filter_complex)])
+    # Scale and pad every image to 1080x1920 (scale passes frames through untouched
+    # when an image already has the target size), then fix the output at 30fps
+    video_filter = (
+        "scale=w=1080:h=1920:force_original_aspect_ratio=decrease,"
+        f"pad=1080:1920:(ow-iw)/2:(oh-ih)/2:color=black,setsar=1,fps=30{encoder['filter']}"
+    )
     
-    # Add mapping and output options
-    cmd.extend([
-        "-map", "[vout]",
-        "-map", "[aout]",
-        "-pix_fmt", "yuv420p",
-        "-preset", "medium",  # Balance between speed and quality
-        "-c:v", "libx264",
+    # Build the command
+    cmd = [
+        "ffmpeg", *encoder["input_args"],
+        "-f", "concat", "-safe", "0", "-i", concat_path,
+        # Add audio with loop
+        "-stream_loop", "-1", "-i", audio_path,
+        "-vf", video_filter,
+        # Trim the looping audio to the video duration
+        "-af", f"atrim=0:{video_duration}",
+        "-map", "0:v",
+        "-map", "1:a",
+        *encoder["output_args"],
         "-c:a", "aac",
         "-fps_mode", "cfr",
         "-strict", "experimental",
         "-b:a", "192k",
         "-shortest",  # End when shortest input ends
         output_path
-    ])
-    
-    # Use event loop's executor to run FFmpeg command asynchronously
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(
-        None,  # Uses the default executor
-        _run_ffmpeg_process,
-        cmd, output_path
-    )
-    
-    return output_path
-
-def _run_ffmpeg_process(cmd, output_path):
-    """Run FFmpeg process synchronously - to be used with run_in_executor"""
-    import subprocess
+    ]
     
-    process = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    stdout, stderr = process.communicate()
+    # Run FFmpeg as a child process on the event loop - waiting on it doesn't
+    # occupy a threadpool slot for the whole encode
+    async with ffmpeg_semaphore:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            # Client went away - don't leave the encode running
+            process.kill()
+            raise
     
     if process.returncode != 0:
         raise Exception(f"FFmpeg error: {stderr.decode()}")
@@ -506,87 +718,84 @@ async def download_slideshow_endpoint(url: str, background_tasks: BackgroundTask
     
     try:
         # Decrypt the URL
-        decrypted_url = decrypt(url, ENCRYPTION_KEY)
+        decrypted_url = decrypt_cached(url)
         
         # Fetch data from the hybrid API
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{HYBRID_API_URL}?url={decrypted_url}&minimal=true",
-                headers={"Content-Type": "application/json"},
-                timeout=30.0
-            )
-            
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=500, 
-                    detail=f"Failed to fetch data from external API: {response.status_code}"
-                )
-            
-            data = response.json()["data"]
-            
-            if data["type"] != "image":
-                raise HTTPException(status_code=400, detail="Only image posts are supported")
-            
-            # Create a unique temp directory with aweme_id + author uid as name
-            folder_name = f"{data['aweme_id']}_{data['author']['uid']}"
-            temp_dir = os.path.join(TEMP_DIR, folder_name)
-            os.makedirs(temp_dir, exist_ok=True)
-            
-            # Track creation time for temp directory cleanup
-            file_timestamps[temp_dir] = datetime.now()
-            
-            # Download images concurrently
-            image_urls = data["image_data"]["no_watermark_image_list"]
-            image_paths = []
-            download_tasks = []
-            
-            for i, image_url in enumerate(image_urls):
-                image_path = os.path.join(temp_dir, f"image_{i}.jpg")
-                image_paths.append(image_path)
-                download_tasks.append(download_file(image_url, image_path))
-            
-            # Use asyncio.gather to download all images concurrently
-            await asyncio.gather(*download_tasks)
-            
-            # Download audio
-            # Use helper function to safely get audio URL
-            audio_url = get_first_from_nested_list(data["music"], ["play_url", "url_list"])
-            if not audio_url:
-                raise HTTPException(status_code=500, detail="Could not find audio URL")
-                
-            audio_path = os.path.join(temp_dir, "audio.mp3")
-            await download_file(audio_url, audio_path)
-            
-            # Create slideshow
-            output_path = os.path.join(temp_dir, "slideshow.mp4")
-            await create_slideshow(image_paths, audio_path, output_path)
-            
-            # Generate filename
-            author_nickname = ''.join(char if char.isalnum() else '_' for char in data["author"]["nickname"])
-            filename = f"{author_nickname}_{int(time.time())}.mp4"
-            
-            # Add task to remove temp files after request completes
-            background_tasks.add_task(lambda: shutil.rmtree(temp_dir) if os.path.exists(temp_dir) else None)
-            
-            # Return the file
-            return FileResponse(
-                path=output_path,
-                filename=filename,
-                media_type="video/mp4"
-            )
-            
+        data = (await fetch_hybrid_data(decrypted_url))["data"]
+        
+        if data["type"] != "image":
+            raise HTTPException(status_code=400, detail="Only image posts are supported")
+        
+        # Create a unique temp directory with aweme_id + author uid as name
+        folder_name = f"{data['aweme_id']}_{data['author']['uid']}"
+        temp_dir = os.path.join(TEMP_DIR, folder_name)
+        os.makedirs(temp_dir, exist_ok=True)
+        
+        # Track creation time for temp directory cleanup
+        Path(temp_dir, CREATED_SENTINEL).touch()
+        
+        # Safely get audio URL
+        audio_urls = ((data.get("music") or _EMPTY).get("play_url") or _EMPTY).get("url_list")
+        audio_url = audio_urls[0] if audio_urls else ""
+        if not audio_url:
+            raise HTTPException(status_code=500, detail="Could not find audio URL")
+
+        audio_path = os.path.join(temp_dir, "audio.mp3")
+
+        # Download images and audio concurrently, with a bounded number in flight
+        # so large slideshows don't open one connection per image at once
+        sem = asyncio.Semaphore(SLIDESHOW_DOWNLOAD_CONCURRENCY)
+        
+        async def _dl(file_url, file_path):
+            async with sem:
+                await download_file(file_url, file_path)
+        
+        image_urls = data["image_data"]["no_watermark_image_list"]
+        image_paths = []
+        download_tasks = []
+
+        for i, image_url in enumerate(image_urls):
+            image_path = os.path.join(temp_dir, f"image_{i}.jpg")
+            image_paths.append(image_path)
+            download_tasks.append(_dl(image_url, image_path))
+
+        download_tasks.append(_dl(audio_url, audio_path))
+
+        # Use asyncio.gather so all N+1 fetches overlap instead of paying the audio RTT last
+        await asyncio.gather(*download_tasks)
+
+        # Create slideshow
+        output_path = os.path.join(temp_dir, "slideshow.mp4")
+        await create_slideshow(image_paths, audio_path, output_path)
+        
+        # Generate filename
+        author_nickname = NON_ALNUM_RE.sub('_', data["author"]["nickname"])
+        filename = f"{author_nickname}_{int(time.time())}.mp4"
+        
+        # Add task to remove temp files after request completes
+        background_tasks.add_task(lambda: shutil.rmtree(temp_dir) if os.path.exists(temp_dir) else None)
+        
+        # Return the file
+        return FileResponse(
+            path=output_path,
+            filename=filename,
+            media_type="video/mp4"
+        )
+        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating slideshow: {str(e)}")
 
     
 if __name__ == "__main__":
     # Optimization 7: Use uvloop for better performance
-    uvloop.install()
+    # (explicit, so a missing uvloop/httptools fails loudly instead of falling back to asyncio/h11)
     uvicorn.run(
         "main:app", 
         host="0.0.0.0", 
         port=3029, 
         reload=False,
+        loop="uvloop",
+        http="httptools",  # C HTTP parser instead of pure-Python h11
         access_log=False,  # Nonaktifkan access log
         log_level="warning"  # Set log level ke paling minimal
     )
\ No newline at end of file
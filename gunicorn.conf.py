@@ -1,11 +1,19 @@
 # gunicorn.conf.py
+from uvicorn_worker import UvicornWorker
+
 from app.main import Host_IP, Host_Port
 
+
+class FastUvicornWorker(UvicornWorker):
+    """UvicornWorker yang memaksa uvloop + httptools (C) alih-alih fallback "auto" (asyncio + h11)"""
+    CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, "loop": "uvloop", "http": "httptools"}
+
+
 # Jumlah worker berdasarkan CPU
 #workers = 4
 
-# Menggunakan Uvicorn worker
-worker_class = "uvicorn.workers.UvicornWorker"
+# Menggunakan Uvicorn worker (uvloop + httptools)
+worker_class = FastUvicornWorker
 
 # Binding ke semua interface dengan port 8000
 bind = f"{Host_IP}:{Host_Port}"